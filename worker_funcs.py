@@ -1,28 +1,93 @@
 from sage.all import *
 import os
+import re
 import sys # For printing to stderr from worker
+import time
+from copy import copy
+try:
+    import resource # POSIX only; without it tasks run without resource limits
+except ImportError:
+    resource = None
+from cysignals.alarm import AlarmInterrupt
 
 
 # --- Determine paths relative to this worker_funcs.py file ---
 _WORKER_DIR = os.path.dirname(os.path.abspath(__file__))
 _PACKAGES_DIR = os.path.join(_WORKER_DIR, 'Packages')
 
-try:
-    print(f"WORKER (pid {os.getpid()}): Loading {os.path.join(_PACKAGES_DIR, 'balancefunctions.sage')}...", file=sys.stderr)
-    load(os.path.join(_PACKAGES_DIR, 'balancefunctions.sage'))
-    
+# --- Invariant modules and registry ---
+# Files defining invariants and properties, loaded into this module's globals on demand.
+INVARIANT_MODULES = {
+    'balancefunctions': os.path.join(_PACKAGES_DIR, 'balancefunctions.sage'),
     # If graph_theory.py's 'invariants' list provides other top-level named functions you are using by name:
-    print(f"WORKER (pid {os.getpid()}): Loading {os.path.join(_PACKAGES_DIR, 'graph_theory.py')}...", file=sys.stderr)
-    load(os.path.join(_PACKAGES_DIR, 'graph_theory.py'))
-    
+    'graph_theory': os.path.join(_PACKAGES_DIR, 'graph_theory.py'),
+}
+# Environment variable naming the modules loaded as soon as this file is imported:
+# comma separated keys of INVARIANT_MODULES, "all" (the default) or "none".
+# Pool workers are forked from a forkserver that imported this file once (see
+# InvariantWorkerPool), so these are loaded once and inherited by every worker.
+WORKER_PRELOAD_ENV = "GT_WORKER_PRELOAD"
+
+INVARIANT_REGISTRY = {} # function name -> function, for everything the loaded modules define
+_loaded_modules = set()
+_module_sources = {}
+
+def load_invariant_module(module_name):
+    """Loads one of INVARIANT_MODULES (once) and registers the functions it defines."""
+    if module_name in _loaded_modules:
+        return
+    before = dict(globals())
+    print(f"WORKER (pid {os.getpid()}): Loading {INVARIANT_MODULES[module_name]}...", file=sys.stderr)
+    load(INVARIANT_MODULES[module_name])
+    _loaded_modules.add(module_name)
+    for name, value in list(globals().items()):
+        if callable(value) and before.get(name) is not value:
+            INVARIANT_REGISTRY[name] = value
+
+def _modules_defining(name):
+    """The INVARIANT_MODULES whose source has a top-level 'def name(' (read without executing them)."""
+    pattern = re.compile(rf"^def {re.escape(name)}\(", re.MULTILINE)
+    for module_name, path in INVARIANT_MODULES.items():
+        if module_name not in _module_sources:
+            with open(path) as f:
+                _module_sources[module_name] = f.read()
+        if pattern.search(_module_sources[module_name]):
+            yield module_name
+
+def _lookup_invariant(name):
+    """
+    Returns the invariant or property function called name, loading only the
+    module that defines it if it is not registered yet (all modules as a last resort).
+    """
+    if name not in INVARIANT_REGISTRY:
+        for module_name in list(_modules_defining(name)) + list(INVARIANT_MODULES):
+            load_invariant_module(module_name)
+            if name in INVARIANT_REGISTRY:
+                break
+    if name not in INVARIANT_REGISTRY:
+        raise NameError(f"Invariant function '{name}' not found in any of worker_funcs.INVARIANT_MODULES.")
+    return INVARIANT_REGISTRY[name]
+
+try:
+    _preload = os.environ.get(WORKER_PRELOAD_ENV, "all")
+    for _module_name in (INVARIANT_MODULES if _preload == "all" else [m for m in _preload.split(",") if m and m != "none"]):
+        load_invariant_module(_module_name)
     print(f"WORKER (pid {os.getpid()}): Finished loading dependency scripts.", file=sys.stderr)
 except Exception as e:
     print(f"WORKER (pid {os.getpid()}): ERROR loading dependency scripts: {type(e).__name__}: {e}", file=sys.stderr)
 
-def _compute_invariant_value_worker(invariant_func_name_to_call, graph_as_g6string, results_dict):
+_memory_error_seen = False # set once a task ran out of memory; the pool worker then exits
+
+def _note_memory_error(e):
+    global _memory_error_seen
+    if isinstance(e, MemoryError):
+        _memory_error_seen = True
+
+def _compute_invariant_value(invariant_func_name_to_call, graph_as_g6string):
     """
-    Worker function to compute an invariant value for a graph.
-    It looks up invariant_func_name_to_call in its own global scope.
+    Computes an invariant value for a graph in this worker.
+    It looks up invariant_func_name_to_call in INVARIANT_REGISTRY.
+    Returns the value as a float, or an "Error: ..." string.
     """
     g6_key = graph_as_g6string 
     inv_name_key = invariant_func_name_to_call
@@ -30,40 +95,200 @@ def _compute_invariant_value_worker(invariant_func_name_to_call, graph_as_g6stri
     try:
         graph_obj = Graph(graph_as_g6string) # Recreate graph object in the worker
 
-        # Get the actual invariant function from this worker's global scope
-        # (populated by the load() commands at the top of this file)
-        if invariant_func_name_to_call not in globals():
-            raise NameError(f"Invariant function '{invariant_func_name_to_call}' not found in worker's global scope. Check load() statements in worker_funcs.py.")
+        actual_invariant_func = _lookup_invariant(invariant_func_name_to_call)
         
-        actual_invariant_func = globals()[invariant_func_name_to_call]
-        
-        value = float(actual_invariant_func(graph_obj)) 
-        results_dict[(inv_name_key, g6_key)] = value
+        return float(actual_invariant_func(graph_obj)) 
     except Exception as e:
+        _note_memory_error(e)
         error_message = f"Error: {type(e).__name__} - {str(e)[:150]}" # Keep error message concise
-        results_dict[(inv_name_key, g6_key)] = error_message 
         # This print helps debug worker-specific issues if they don't propagate well
         print(f"WORKER (pid {os.getpid()}) ERROR computing {inv_name_key} for graph {g6_key}: {error_message}", file=sys.stderr)
+        return error_message
+
+def _compute_invariant_value_worker(invariant_func_name_to_call, graph_as_g6string, results_dict):
+    """
+    Worker function to compute an invariant value for a graph.
+    It looks up invariant_func_name_to_call in INVARIANT_REGISTRY.
+    """
+    results_dict[(invariant_func_name_to_call, graph_as_g6string)] = _compute_invariant_value(invariant_func_name_to_call, graph_as_g6string)
 
 
-def _compute_property_value_worker(property_func_name_to_call, graph_as_g6string, results_dict):
+# Structural queries that several invariants tend to ask of the same graph.
+# In a graph-major task they are computed once per graph and shared.
+_SHARED_GRAPH_QUERIES = ['is_connected', 'distance_matrix', 'distance_all_pairs', 'spectrum',
+                         'degree_sequence', 'diameter', 'radius', 'girth', 'automorphism_group']
+
+def _share_graph_queries(graph_obj):
     """
-    Worker function to compute a property value for a graph.
-    Looks up property_func_name_to_call in its own global scope.
+    Replaces the _SHARED_GRAPH_QUERIES methods of graph_obj (on this instance only)
+    by memoized versions. Each call hands out a copy, so an invariant that modifies
+    e.g. its degree sequence in place does not affect the next one.
+    """
+    for method_name in _SHARED_GRAPH_QUERIES:
+        method = getattr(graph_obj, method_name, None)
+        if method is None:
+            continue
+        def memoized(*args, _method=method, _cache={}, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            if key not in _cache:
+                _cache[key] = _method(*args, **kwargs)
+            return copy(_cache[key])
+        setattr(graph_obj, method_name, memoized)
+    return graph_obj
+
+def _compute_graph_invariants(graph_as_g6string, invariant_names, sub_timeout=None):
+    """
+    Graph-major task: parses the graph once and computes each invariant in
+    invariant_names on it, each under its own sub_timeout (in seconds, through
+    Sage's alarm()). Queries in _SHARED_GRAPH_QUERIES are computed once and
+    reused across the invariants.
+    Returns {"values": {name: float}, "errors": {name: "Error: ..."},
+    "timeouts": [name, ...], "seconds": {name: elapsed}}.
+    """
+    results = {"values": {}, "errors": {}, "timeouts": [], "seconds": {}}
+    try:
+        graph_obj = _share_graph_queries(Graph(graph_as_g6string))
+    except Exception as e:
+        for name in invariant_names:
+            results["errors"][name] = f"Error: {type(e).__name__} - {str(e)[:150]}"
+        return results
+
+    for name in invariant_names:
+        start = time.time()
+        try:
+            invariant_func = _lookup_invariant(name)
+            if sub_timeout:
+                alarm(sub_timeout)
+            try:
+                results["values"][name] = float(invariant_func(graph_obj))
+            finally:
+                if sub_timeout:
+                    cancel_alarm()
+        except AlarmInterrupt:
+            results["timeouts"].append(name)
+        except Exception as e:
+            _note_memory_error(e)
+            results["errors"][name] = f"Error: {type(e).__name__} - {str(e)[:150]}"
+            print(f"WORKER (pid {os.getpid()}) ERROR computing {name} for graph {graph_as_g6string}: {results['errors'][name]}", file=sys.stderr)
+        results["seconds"][name] = time.time() - start
+    return results
+
+
+def _compute_property_value(property_func_name_to_call, graph_as_g6string):
+    """
+    Computes a property value for a graph in this worker.
+    Looks up property_func_name_to_call in INVARIANT_REGISTRY.
+    Returns the value as a bool, or an "Error: ..." string.
     """
     g6_key = graph_as_g6string
     prop_name_key = property_func_name_to_call
     try:
         graph_obj = Graph(graph_as_g6string)
 
-        if property_func_name_to_call not in globals():
-            raise NameError(f"Property function '{property_func_name_to_call}' not found in worker's global scope. Check load() statements in worker_funcs.py.")
-            
-        actual_property_func = globals()[property_func_name_to_call]
+        actual_property_func = _lookup_invariant(property_func_name_to_call)
 
-        value = bool(actual_property_func(graph_obj))
-        results_dict[(prop_name_key, g6_key)] = value
+        return bool(actual_property_func(graph_obj))
     except Exception as e:
+        _note_memory_error(e)
         error_message = f"Error: {type(e).__name__} - {str(e)[:150]}"
-        results_dict[(prop_name_key, g6_key)] = error_message
-        print(f"WORKER (pid {os.getpid()}) ERROR computing {prop_name_key} for graph {g6_key}: {error_message}", file=sys.stderr)
\ No newline at end of file
+        print(f"WORKER (pid {os.getpid()}) ERROR computing {prop_name_key} for graph {g6_key}: {error_message}", file=sys.stderr)
+        return error_message
+
+def _compute_property_value_worker(property_func_name_to_call, graph_as_g6string, results_dict):
+    """
+    Worker function to compute a property value for a graph.
+    Looks up property_func_name_to_call in INVARIANT_REGISTRY.
+    """
+    results_dict[(property_func_name_to_call, graph_as_g6string)] = _compute_property_value(property_func_name_to_call, graph_as_g6string)
+
+# Compact result records, as sent back over the pool pipe:
+# (name, graph6 string, value or "Error: ..." string, seconds).
+def _compute_invariant_record(invariant_func_name_to_call, graph_as_g6string):
+    start = time.time()
+    value = _compute_invariant_value(invariant_func_name_to_call, graph_as_g6string)
+    return (invariant_func_name_to_call, graph_as_g6string, value, time.time() - start)
+
+def _compute_property_record(property_func_name_to_call, graph_as_g6string):
+    start = time.time()
+    value = _compute_property_value(property_func_name_to_call, graph_as_g6string)
+    return (property_func_name_to_call, graph_as_g6string, value, time.time() - start)
+
+# --- Sharded balance search (see parallel_gray_code_balance in balancefunctions.sage) ---
+_balance_shard_found = None # shared multiprocessing Value, set once per pool worker
+
+def _init_balance_shard_worker(found):
+    """Pool initializer: keeps the shared 'first shard at the parity bound' Value."""
+    global _balance_shard_found
+    _balance_shard_found = found
+
+def _balance_shard_worker(task):
+    """
+    Runs the Gray-code balance search on one shard of the coloring space.
+    task is (nbrs, prefix_mask, free, index); returns (value, coloring bitmask).
+    """
+    nbrs, prefix_mask, free, index = task
+    load_invariant_module('balancefunctions')
+    return gray_code_balance(nbrs, prefix_mask=prefix_mask, free=free, index=index, found=_balance_shard_found)
+
+def _balance_census_worker(task):
+    """Runs balance_census_part(n, res, mod, options) for one geng part of a census."""
+    load_invariant_module('balancefunctions')
+    return balance_census_part(*task)
+
+
+# --- Persistent worker pool (see InvariantWorkerPool in gt_precomputed_database.sage) ---
+def _set_memory_limit(memory_limit):
+    """Caps this process's address space at memory_limit bytes, so allocations beyond it raise MemoryError."""
+    if resource is None or not memory_limit:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, hard))
+    except (ValueError, OSError) as e:
+        print(f"WORKER (pid {os.getpid()}): could not set RLIMIT_AS: {e}", file=sys.stderr)
+
+def _set_cpu_limit(cpu_limit):
+    """Lets the next task use cpu_limit more seconds of CPU time; past that the kernel kills this process with SIGXCPU."""
+    if resource is None or not cpu_limit:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    new_soft = int(usage.ru_utime + usage.ru_stime + cpu_limit) + 1
+    if hard != resource.RLIM_INFINITY:
+        new_soft = min(new_soft, hard)
+    try:
+        resource.setrlimit(resource.RLIMIT_CPU, (new_soft, hard))
+    except (ValueError, OSError) as e:
+        print(f"WORKER (pid {os.getpid()}): could not set RLIMIT_CPU: {e}", file=sys.stderr)
+
+def _pool_worker_main(conn, memory_limit=None, cpu_limit=None):
+    """
+    Main loop of a long-lived pool worker. By the time it runs, importing this
+    module has already loaded the invariant definitions. Announces itself with
+    ("ready", pid), then runs (function name, args) tasks for functions of this
+    module received on conn and sends back each return value, until it
+    receives None. memory_limit (bytes of address space) holds for the whole
+    worker, cpu_limit (seconds of CPU time) for each task. Each reply is a
+    (return value, exiting) pair: after a task ran out of memory the worker
+    says so and exits, so that the pool starts a fresh one instead of sending
+    it another task.
+    """
+    _set_memory_limit(memory_limit)
+    conn.send(("ready", os.getpid()))
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, OSError): # the parent went away
+            break
+        if task is None:
+            break
+        func_name, args = task
+        _set_cpu_limit(cpu_limit)
+        try:
+            result = globals()[func_name](*args)
+        except MemoryError as e: # the task functions catch their own errors, this is for the others
+            _note_memory_error(e)
+            result = f"Error: MemoryError - {str(e)[:150]}"
+        conn.send((result, _memory_error_seen))
+        if _memory_error_seen:
+            break